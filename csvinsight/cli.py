@@ -6,17 +6,16 @@
 """Console script for csvinsight."""
 import argparse
 import csv
-import codecs
 import collections
 import distutils.spawn
 import functools
-import gzip
+import io
+import itertools
 import json
 import logging
 import multiprocessing
 import os
 import os.path as P
-import subprocess
 import sys
 import tempfile
 import yaml
@@ -29,10 +28,11 @@ from . import summarize
 _LOGGER = logging.getLogger(__name__)
 
 _GZIP_MAGIC = b'\x1f\x8b'
-_MAX_ARGS = 100
-"""The max number of arguments to pass to a single subprocess call."""
-
 _LINES_PER_PART = 100000
+_MIN_SPLIT_LINE_LENGTH = 64
+"""The line length from which splitting lines beats csv.reader."""
+_SORT_BUFFER_MIB = 2048
+"""The total size of the main memory buffers of all the sorts running at once."""
 
 
 def _print_report(header, histogram, results, fout=sys.stdout):
@@ -59,44 +59,39 @@ Field Length: min #, max #, average:
 
 
 def _print_column_summary(summary, fout):
-    fmt_str1 = ('%(number)d. %(name)s -> Uniques: %(num_uniques)d ; '
-                'Fills: %(num_fills)d ; Fill Rate: %(fill_rate).1f%%')
-    fmt_str2 = '    Field Length:  min %(min_len)d, max %(max_len)d, avg %(avg_len).2f'
-    fmt_str3 = "        {}  {:5.2f} %  {}"
-    print(fmt_str1 % summary, file=fout)
-    print(fmt_str2 % summary, file=fout)
-
-    if summary['num_uniques'] == -1:
-        print('', file=fout)
-        return
-
-    num_samples = remainder = summary['num_values']
-    print("        Counts      Percent  Field Value", file=fout)
-    for count, value in summary['most_common']:
-        if value == '':
-            value = 'NULL'
-        print(
-            fmt_str3.format(
-                str(count).ljust(10), count * 100.0 / num_samples, value
-            ), file=fout
-        )
-        remainder -= count
-    if remainder:
-        print(
-            fmt_str3.format(
-                str(remainder).ljust(10), remainder * 100.0 / num_samples, 'Other'
-            ), file=fout
-        )
-    print('', file=fout)
+    fmt_str = ('%(number)d. %(name)s -> Uniques: %(num_uniques)d ; '
+               'Fills: %(num_fills)d ; Fill Rate: %(fill_rate).1f%%\n'
+               '    Field Length:  min %(min_len)d, max %(max_len)d, avg %(avg_len).2f\n')
+    value_fmt_str = '        %-10d  %5.2f %%  %s\n'
+
+    #
+    # Build the whole summary up front and write it out in one go, instead of
+    # going through print once per line.
+    #
+    parts = [fmt_str % summary]
+    if summary['num_uniques'] != -1:
+        num_samples = remainder = summary['num_values']
+        parts.append('        Counts      Percent  Field Value\n')
+        for count, value in summary['most_common']:
+            parts.append(value_fmt_str % (count, count * 100.0 / num_samples, value or 'NULL'))
+            remainder -= count
+        if remainder:
+            parts.append(value_fmt_str % (remainder, remainder * 100.0 / num_samples, 'Other'))
+    parts.append('\n')
+    fout.write(''.join(parts))
 
 
 def _run_in_memory(reader, args):
-    header, histogram, columns = split.split_in_memory(
+    #
+    # Counting the values is O(N), unlike sorting them, and only needs to
+    # keep each unique value once.
+    #
+    header, histogram, counts = split.count_in_memory(
         reader, list_columns=args.list_fields, list_separator=args.list_separator
     )
     column_summaries = [
-        summarize.summarize_sorted(iter(sorted(col)), most_common=args.most_common)
-        for col in columns
+        summarize.summarize_counts(col, most_common=args.most_common)
+        for col in counts
     ]
     return header, histogram, column_summaries
 
@@ -139,6 +134,53 @@ class Dialect(csv.Dialect):
         return 'Dialect(%s)' % ', '.join(params)
 
 
+def _make_reader(fin, dialect):
+    """Return a reader that parses the rows of fin according to dialect.
+
+    Behaves like csv.reader, but is faster for dialects without quoting,
+    where most lines can simply be split on the delimiter.
+    """
+    #
+    # Splitting costs more than csv.reader per line, but less per character,
+    # so it only wins once lines get long enough.  Judge the file by its
+    # first line.
+    #
+    lines = iter(fin)
+    first_line = next(lines, '')
+    lines = itertools.chain((first_line,), lines) if first_line else lines
+    if dialect.quoting == csv.QUOTE_NONE and len(first_line) >= _MIN_SPLIT_LINE_LENGTH:
+        return _read_unquoted(lines, dialect)
+    return csv.reader(lines, dialect=dialect)
+
+
+def _read_unquoted(lines, dialect):
+    delimiter = dialect.delimiter
+    #
+    # Escape characters and, with skipinitialspace, spaces at the start of
+    # a field need csv.reader's rules.  If the dialect has neither, check
+    # for a carriage return again instead, which costs next to nothing.
+    #
+    escapechar = dialect.escapechar or '\r'
+    if dialect.skipinitialspace:
+        leading_space, delimited_space = ' ', delimiter + ' '
+    else:
+        leading_space = delimited_space = '\r'
+
+    for line in lines:
+        #
+        # Leave the odd lines to csv.reader.  It reads exactly one record,
+        # including any further lines that an escaped newline continues
+        # onto, and we carry on from there.
+        #
+        if ('\r' in line or '\0' in line or escapechar in line or delimited_space in line
+                or line.startswith(leading_space)):
+            yield next(csv.reader(itertools.chain((line,), lines), dialect=dialect))
+        elif line == '\n':
+            yield []
+        else:
+            yield line.rstrip('\n').split(delimiter)
+
+
 def _parse_dialect(pairs_as_strings):
     _LOGGER.debug('locals: %r', locals())
     kwargs = dict(str(pair).split('=', 1) for pair in pairs_as_strings)
@@ -195,7 +237,8 @@ If possible, install pigz on your system.  It makes better use of multiple
 cores when compressing and decompressing.
 
 Writes temporary files to disk, so make sure --tempdir is set to something with
-plenty of space.
+plenty of space.  If that space is plentiful or fast (e.g. a tmpfs such as
+/dev/shm), --no-compress skips compressing the temporary files altogether.
 
 CSV dialects are specified as space-separated key-value pairs, for example:
 
@@ -231,6 +274,10 @@ For the list of available dialect parameters, see:
         '--no-tiny', action='store_true',
         help='Skip the in-memory optimization for tiny CSV files'
     )
+    parser.add_argument(
+        '--no-compress', action='store_true',
+        help='Do not compress temporary files.  Faster, but uses more disk space'
+    )
     parser.add_argument(
         '--lines-per-part', default=_LINES_PER_PART,
         help='The number of lines in each part when splitting large files'
@@ -280,12 +327,13 @@ For the list of available dialect parameters, see:
     #
     if _is_tiny(args.path) and not args.no_tiny:
         with _open_for_reading(args.path) as fin:
-            reader = csv.reader(fin, dialect=csv_dialect)
+            reader = _make_reader(fin, csv_dialect)
             header, histogram, results = _run_in_memory(reader, args)
     else:
         with _open_for_reading(args.path) as fin:
-            header = next(csv.reader(fin, dialect=csv_dialect))
-        part_paths = _split_large_file(args.path, lines_per_part=args.lines_per_part)
+            header = next(_make_reader(fin, csv_dialect))
+        part_paths = _split_large_file(args.path, lines_per_part=args.lines_per_part,
+                                       compress=not args.no_compress)
         histogram, results = _process_multi(header, part_paths, csv_dialect, args)
         for part in part_paths:
             os.unlink(part)
@@ -318,14 +366,21 @@ def _open_for_reading(path, encoding='utf-8'):
     :rtype: fileobj
     """
     if _is_gzipped(path):
-        fin = gzip.GzipFile(path, mode='rb')
         #
-        # GzipFile docs state that it supports outputting text, but this
-        # doesn't seem so in practice, so we take care of it ourselves.
+        # TextIOWrapper decodes in C, a buffer at a time, unlike
+        # codecs.getreader, and handles newlines the same way as open does.
         #
-        return codecs.getreader(encoding)(fin)
+        fin = io.TextIOWrapper(split.gzip.GzipFile(path, mode='rb'), encoding=encoding)
     else:
-        return open(path, 'r')
+        fin = open(path, 'r', encoding=encoding)
+    #
+    # We read the file once, from start to finish.  Telling the kernel so
+    # lets it read further ahead: on Linux, it doubles the readahead window.
+    # Not every platform supports this (e.g. macOS), and it is only a hint.
+    #
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fin.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return fin
 
 
 def _is_tiny(path):
@@ -340,7 +395,7 @@ def _is_gzipped(path):
         return fin.read(len(_GZIP_MAGIC)) == _GZIP_MAGIC
 
 
-def _split_large_file(path, lines_per_part=_LINES_PER_PART):
+def _split_large_file(path, lines_per_part=_LINES_PER_PART, compress=True):
     """Split a large file into smaller files.
 
     Uses GNU command-line tools (e.g. gzip, gsplit) under the cover to
@@ -351,10 +406,10 @@ def _split_large_file(path, lines_per_part=_LINES_PER_PART):
 
     :arg str path: The full path to the file to split.
     :arg str lines_per_part: The max number of lines to include in each part.
+    :arg bool compress: Whether to gzip the parts.
     :returns: The path to each part
     :rtype: list
     """
-    cat_command = plumbum.local['cat'][path]
     tail_command = plumbum.local['tail']['-n', '+2']
 
     gzip_exe = _get_exe('pigz', 'gzip')
@@ -371,14 +426,20 @@ def _split_large_file(path, lines_per_part=_LINES_PER_PART):
     os.mkdir(P.join(tmpdir, 'columns'))
 
     split_exe = _get_exe('gsplit', 'split')
-    split_flags = ['--filter', "%s > $FILE.gz" % gzip_exe,
-                   '--lines=%s' % lines_per_part, '-', prefix + '/']
+    split_flags = ['--lines=%s' % lines_per_part, '-', prefix + '/']
+    if compress:
+        split_flags = [
+            '--filter', "%s -%d > $FILE.gz" % (gzip_exe, split.COMPRESS_LEVEL)
+        ] + split_flags
     split_command = plumbum.local[split_exe][split_flags]
 
+    #
+    # tail can read an uncompressed file by itself, no need for cat.
+    #
     if _is_gzipped(path):
         chain = gzip_command | tail_command | split_command
     else:
-        chain = cat_command | tail_command | split_command
+        chain = tail_command[path] | split_command
 
     _LOGGER.debug('chain: %s', chain)
     chain()
@@ -397,7 +458,7 @@ def _get_exe(*preference):
 
 
 def _split_file(header, path, dialect=None, list_columns=None, list_separator=None,
-                encoding='utf-8'):
+                compress=True, encoding='utf-8'):
     """Split a CSV file into columns, one column per file.
 
     :arg str header: The names for each column of the file.
@@ -405,6 +466,7 @@ def _split_file(header, path, dialect=None, list_columns=None, list_separator=No
     :arg Dialect dialect: The CSV dialect to use when parsing.
     :arg list list_columns:
     :arg str list_separator:
+    :arg bool compress: Whether to gzip the column files.
 
     Returns the header, the row length histogram, and the paths of the files
     storing each column.
@@ -420,9 +482,26 @@ def _split_file(header, path, dialect=None, list_columns=None, list_separator=No
     assert list_separator
 
     with _open_for_reading(path) as fin:
-        reader = csv.reader(fin, dialect=dialect)
+        reader = _make_reader(fin, dialect)
         return split.split(header, reader, list_columns=list_columns,
-                           list_separator=list_separator, path=path)
+                           list_separator=list_separator, path=path, compress=compress)
+
+
+_WORKER_STATE = {}
+"""The state shared by all _split_part calls within a single subprocess."""
+
+
+def _init_worker(header, dialect, list_columns, list_separator, compress):
+    """Initialize a subprocess for running _split_part."""
+    _WORKER_STATE.update(
+        header=header, dialect=dialect,
+        list_columns=list_columns, list_separator=list_separator, compress=compress,
+    )
+
+
+def _split_part(path):
+    """Split a single part into columns using the subprocess's shared state."""
+    return _split_file(path=path, **_WORKER_STATE)
 
 
 def _process_multi(header, paths, dialect, args):
@@ -431,10 +510,9 @@ def _process_multi(header, paths, dialect, args):
     The multiple processes come in handy for:
 
         1. Splitting the files into columns
-        2. Sorting each column
+        2. Summarizing each column
 
     Assumes the files contain the same columns.
-    Assumes the files are gzipped.
 
     Returns a header, the row length histogram, and a dictionary summary of the
     results.
@@ -442,37 +520,46 @@ def _process_multi(header, paths, dialect, args):
     #
     # Use multiple processes for splitting the N input files.
     # This gives us N sets of M columns.
-    # After splitting, aggregate the split results.
-    # This gives us a single set of M columns.
+    # After splitting, group the resulting files by column.
+    # This gives us M columns, each stored across N files.
     #
-    my_split = functools.partial(
-        _split_file, header, dialect=dialect,
-        list_columns=args.list_fields, list_separator=args.list_separator
+    # The header, dialect and list settings are the same for every part, so
+    # we hand them to each subprocess once, when it starts, instead of
+    # pickling them along with every part.
+    #
+    compress = not args.no_compress
+    initargs = (header, dialect, args.list_fields, args.list_separator, compress)
+    pool = multiprocessing.Pool(
+        processes=args.subprocesses, initializer=_init_worker, initargs=initargs
     )
-    pool = multiprocessing.Pool(processes=args.subprocesses)
 
     #
     # each result consists of header, histogram and paths
     #
-    results = pool.map(my_split, paths)
+    results = pool.map(_split_part, paths)
     histograms, paths = zip(*results)
 
     agg_histogram = _aggregate_histograms(histograms)
-    agg_paths = _concatenate_tables(paths)
+    columns = _transpose_tables(paths)
 
     #
-    # We're already running sort_and_summarize in multiple subprocesses, so
-    # disable parallelization in that function (num_subprocesses=1).
+    # Count the values of each column in memory where possible, and sort
+    # only the columns with too many unique values.  We're already running
+    # in multiple subprocesses, so disable parallelization in the sort
+    # (num_subprocesses=1), and share the memory between the sorts.  The
+    # counting gets the same share of memory as the sort it replaces.
     #
-    my_sort = functools.partial(
-        summarize.sort_and_summarize, path_is_gzipped=True,
-        compress_temporary=True, num_subprocesses=1,
-        most_common=args.most_common,
+    buffer_mib = max(1, _SORT_BUFFER_MIB // args.subprocesses)
+    my_summarize = functools.partial(
+        summarize.count_and_summarize, path_is_gzipped=compress,
+        max_uniques=summarize.MAX_UNIQUES, max_bytes=buffer_mib << 20, compress_temporary=compress,
+        buffer_size='%dM' % buffer_mib, num_subprocesses=1, most_common=args.most_common,
     )
-    results = pool.map(my_sort, agg_paths)
+    results = pool.map(my_summarize, columns)
 
-    for path in agg_paths:
-        os.unlink(path)
+    for column in columns:
+        for path in column:
+            os.unlink(path)
 
     return agg_histogram, results
 
@@ -493,46 +580,19 @@ def _aggregate_histograms(histograms):
     return aggregated
 
 
-def _concatenate(paths, batch_size=_MAX_ARGS):
-    """Concatenate the specified files together into a single file.
-
-    It's possible that paths contains more than what we can pass in a
-    single subprocess call, so we split them into batches and append
-    each batch individually.
-
-    :param iterator paths: The paths to concatenate
-    :param int batch_size: The max number of files to pass to a single cat call
-    :returns: The new file path
-    :rtype: str
-    """
-    handle, path = tempfile.mkstemp()
-    os.close(handle)
-
-    for batch in split.make_batches(paths, batch_size=_MAX_ARGS):
-        with open(path, 'ab') as fout:
-            command = ['cat'] + batch
-            _LOGGER.debug('command: %r', command)
-            subprocess.check_call(command, stdout=fout)
-
-    for p in paths:
-        os.unlink(p)
-
-    return path
-
-
-def _concatenate_tables(tables, concatenate=_concatenate):
-    """Concatenate the tables together to form one big table.
+def _transpose_tables(tables):
+    """Transpose a list of tables into a list of columns.
 
     Each table is a list of columns, where a column is stored in a separate
-    file.  To create the big table, this function concatenates the respective
-    columns together.
+    file.  The result contains, for each column, the files storing that
+    column across all the tables.  Gzipped files concatenate trivially, so
+    the downstream steps can read each column's files in sequence, as if they
+    were a single file, without having to concatenate them on disk first.
 
     Each table must contain the same number of columns for this to work.
 
-    Deletes the files from the individual tables after concatenating.
-
     :arg list tables: A list of tables.
-    :returns: A table, as a list of concatenated columns.
+    :returns: A list of columns, each as a list of paths.
     :rtype: list
     :raises ValueError: if the tables contain a different number of columns
     """
@@ -541,11 +601,7 @@ def _concatenate_tables(tables, concatenate=_concatenate):
         if not len(tbl) == num_columns:
             raise ValueError('number of columns must be the same for each table')
 
-    concat_paths = []
-    for column_number in range(num_columns):
-        concat_paths.append(_concatenate([tbl[column_number] for tbl in tables]))
-
-    return concat_paths
+    return [list(column) for column in zip(*tables)]
 
 
 if __name__ == "__main__":
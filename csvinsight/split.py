@@ -1,70 +1,131 @@
 """Splits a CSV into multiple columns, one column per file."""
 import collections
-import gzip
+import io
+import itertools
 import logging
 import os
 import os.path as P
 import queue
 import threading
 
+#
+# python-isal wraps Intel's ISA-L, which compresses and decompresses several
+# times faster than zlib.  Use it when it's available.  The other modules get
+# gzip from here, so that they all make the same choice.
+#
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 MAX_QUEUE_SIZE = 10
 SENTINEL = None
-DEFAULT_BATCH_SIZE = 10000  # Empirically proven to work best
+DEFAULT_BATCH_SIZE = 10000
+"""The max number of rows in a batch."""
+MIN_BATCH_SIZE = 256
+"""The min number of rows in a batch, however wide the rows are."""
+BATCH_CELLS = 50000
+"""The number of cells to aim for in a batch.
+
+Batches that stay within the CPU caches are processed much faster, which
+matters more than the overhead of handling more of them."""
 LIST_SEPARATOR = ';'
 TEXT_ENCODING = 'utf-8'
+COMPRESS_LEVEL = 1
+"""The gzip compression level for temporary files.
+
+They are read back once and deleted, so favor speed over size."""
+WRITE_BUFFER_SIZE = 1 << 16
+"""The buffer size for writing temporary files, one buffer per column.
+
+Writes larger than this go straight through, so it need not be large."""
 
 
 def _open_temp(subdir, column_id):
     path = P.join(subdir, '%04d.gz' % column_id)
-    fout = gzip.GzipFile(path, mode='wb')
+    #
+    # Buffer the writes so that smaller ones get coalesced before they reach
+    # the compressor, which has a relatively high per-call overhead.
+    #
+    fout = io.BufferedWriter(
+        gzip.open(path, mode='wb', compresslevel=COMPRESS_LEVEL),
+        buffer_size=WRITE_BUFFER_SIZE,
+    )
+    return fout, path
+
+
+def _open_temp_uncompressed(subdir, column_id):
+    path = P.join(subdir, '%04d' % column_id)
+    fout = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
     return fout, path
 
 
 class WriterThread(threading.Thread):
-    """Reads column values from a queue and writes them to a temporary file.
+    """Reads column values from a queue and writes them to temporary files.
+
+    A single thread may write several columns, one temporary file per column.
 
-    :arg str subdir: The subdirectory where the output file should exist.
-    :arg int column_id: The ordinal number of the column being written.
-    :arg queue.Queue queue: The queue to read from
+    :arg str subdir: The subdirectory where the output files should exist.
+    :arg list column_ids: The ordinal numbers of the columns to write.
+    :arg queue.SimpleQueue queue: The queue to read from.  Each item is a tuple
+        of (column_id, batch), where the batch contains one value per line,
+        without the trailing newline.
     :arg open_temp: A callback for opening a temporary file.
+    :arg threading.Semaphore semaphore: If not None, released once per batch written.
     """
-    def __init__(self, subdir, column_id, queue, open_temp=_open_temp):
-        super(WriterThread, self).__init__()
-        self._column_id = column_id
+    def __init__(self, subdir, column_ids, queue, open_temp=_open_temp, semaphore=None):
+        super().__init__()
         self._queue = queue
-        self._fout, self._path = open_temp(subdir, column_id)
+        self._semaphore = semaphore
+        self._fouts = {}
+        self.paths = {}
+        for column_id in column_ids:
+            self._fouts[column_id], self.paths[column_id] = open_temp(subdir, column_id)
 
     def run(self):
-        lines = True
-        while lines is not SENTINEL:
-            lines = self._queue.get()
-            if lines is not SENTINEL:
-                self._fout.write(('\n'.join(lines) + '\n').encode(TEXT_ENCODING))
-            self._queue.task_done()
-        self._fout.close()
+        fouts = self._fouts
+        semaphore = self._semaphore
+        for column_id, text in iter(self._queue.get, SENTINEL):
+            fout = fouts[column_id]
+            #
+            # Write the trailing newline separately, instead of copying
+            # the entire batch just to append it.
+            #
+            fout.write(text.encode(TEXT_ENCODING))
+            fout.write(b'\n')
+            if semaphore is not None:
+                semaphore.release()
+        for fout in fouts.values():
+            fout.close()
 
 
 def make_batches(iterable, batch_size=DEFAULT_BATCH_SIZE):
-    batch = []
-    for row in iterable:
-        if len(batch) == batch_size:
-            yield batch
-            batch = []
-        batch.append(row)
-    if batch:
-        yield batch
+    #
+    # islice collects each batch in C, instead of appending one item at a
+    # time in Python.  Iteration stops at the first empty batch.
+    #
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, batch_size)), [])
+
+
+def _batch_size(num_columns):
+    """Return the number of rows to put in each batch, given the row width."""
+    return max(MIN_BATCH_SIZE, min(DEFAULT_BATCH_SIZE, BATCH_CELLS // max(num_columns, 1)))
 
 
 def _populate_queues(header, reader, queues, list_columns=[],
-                     list_separator=LIST_SEPARATOR, batch_size=DEFAULT_BATCH_SIZE):
+                     list_separator=LIST_SEPARATOR, batch_size=None, semaphore=None):
     """Push columns of a csv.Reader into the queues.
 
     :arg list header: The CSV header - names of the columns.
     :arg csv.Reader reader: The csv.Reader to read from.
     :arg list queues: A list of queues to write to, one queue per column.
+        Columns may share a queue.
     :arg list list_columns:
     :arg str list_separator:
     :arg int batch_size: The maximum number of rows to process as a single batch.
+        If None, picks one based on the number of columns.
+    :arg threading.Semaphore semaphore: If not None, acquired once per batch put.
     :returns: A histogram of row lengths
     :rtype: collections.Counter
 
@@ -75,35 +136,55 @@ def _populate_queues(header, reader, queues, list_columns=[],
     if len(header) != len(queues):
         raise ValueError('expected one queue per column')
 
+    if batch_size is None:
+        batch_size = _batch_size(len(header))
+
     histogram = collections.Counter()
-    list_column_numbers = [i for (i, name) in enumerate(header) if name in list_columns]
-    nonlist_column_numbers = [i for (i, name) in enumerate(header) if name not in list_columns]
-    assert len(list_column_numbers) + len(nonlist_column_numbers) == len(header)
+    expected_length = len(header)
+    list_columns = set(list_columns)
+    list_column_numbers = {i for (i, name) in enumerate(header) if name in list_columns}
 
     #
     # We put batches on the queue, not the actual values themselves.
-    # This reduces the overhead (number of calls to Queue.put and .get).
+    # This reduces the overhead (number of calls to put and get).
+    #
+    # Each batch is a single string: the column's values joined by newlines.
+    # zip transposes the rows into columns in C, and joining each column
+    # right away means we never keep a list of the values.  For list columns,
+    # replacing the separator with a newline splits the values without ever
+    # creating a separate string for each of them.
     #
     for batch in make_batches(reader, batch_size=batch_size):
-        histogram.update(len(row) for row in batch)
-        columns = [list() for _ in header]
-        for row in batch:
-            if len(header) != len(row):
+        batch_histogram = collections.Counter(map(len, batch))
+        histogram.update(batch_histogram)
+
+        #
+        # Malformed rows are rare, so only filter the batch if it has any.
+        #
+        if batch_histogram[expected_length] == len(batch):
+            rows = batch
+        else:
+            rows = [row for row in batch if len(row) == expected_length]
+            if not rows:
                 continue
-            for col_num in list_column_numbers:
-                columns[col_num].extend(row[col_num].split(list_separator))
-            for col_num in nonlist_column_numbers:
-                columns[col_num].append(row[col_num])
-        for q, values in zip(queues, columns):
-            q.put(values)
-
-    for q in queues:
+
+        for col_num, (q, values) in enumerate(zip(queues, zip(*rows))):
+            if col_num in list_column_numbers:
+                text = list_separator.join(values).replace(list_separator, '\n')
+            else:
+                text = '\n'.join(values)
+            if semaphore is not None:
+                semaphore.acquire()
+            q.put((col_num, text))
+
+    for q in set(queues):
         q.put(SENTINEL)
 
     return histogram
 
 
-def split(header, reader, list_columns=[], list_separator=LIST_SEPARATOR, path=None):
+def split(header, reader, list_columns=[], list_separator=LIST_SEPARATOR, path=None,
+          compress=True):
     """Split a CSV reader into columns, one column per temporary file.
 
     :arg list header: The column names to assume.
@@ -111,6 +192,7 @@ def split(header, reader, list_columns=[], list_separator=LIST_SEPARATOR, path=N
     :arg list list_columns: Column names to treat as containing lists
     :arg str list_separator: The separator to use when splitting lists
     :arg str path: The path to the file being split.  May not be None.
+    :arg bool compress: Whether to gzip the temporary files.
     :returns: histogram, values for each columns
     :rtype: tuple of (list, collections.Counter, list of lists)
 
@@ -139,19 +221,85 @@ def split(header, reader, list_columns=[], list_separator=LIST_SEPARATOR, path=N
 
     os.mkdir(part_columns_dir)
 
-    queues = [queue.Queue(MAX_QUEUE_SIZE) for _ in header]
-    threads = [WriterThread(part_columns_dir, i, q)
-               for i, q in enumerate(queues)]
+    open_temp = _open_temp if compress else _open_temp_uncompressed
+    #
+    # SimpleQueue is implemented in C and much cheaper than Queue, but it is
+    # unbounded.  A single semaphore shared by all the columns restores the
+    # back-pressure, capping the number of batches in flight.
+    #
+    semaphore = threading.BoundedSemaphore(MAX_QUEUE_SIZE * len(header))
+    #
+    # A thread per column means hundreds of threads contending for the GIL
+    # on wide files.  Instead, spread the columns over a few threads, each
+    # with its own queue: enough to keep the CPUs busy compressing, which
+    # releases the GIL.
+    #
+    num_threads = min(len(header), os.cpu_count() or 1)
+    thread_queues = [queue.SimpleQueue() for _ in range(num_threads)]
+    threads = [
+        WriterThread(part_columns_dir, range(i, len(header), num_threads), q,
+                     open_temp=open_temp, semaphore=semaphore)
+        for i, q in enumerate(thread_queues)
+    ]
     for thread in threads:
         thread.start()
 
-    histogram = _populate_queues(header, reader, queues,
-                                 list_columns=list_columns, list_separator=list_separator)
+    queues = [thread_queues[i % num_threads] for i in range(len(header))]
+
+    histogram = _populate_queues(header, reader, queues, list_columns=list_columns,
+                                 list_separator=list_separator, semaphore=semaphore)
+
+    #
+    # Wait for the threads themselves, not just the queues: a thread closes
+    # its file only after it has consumed the sentinel, and the file is not
+    # complete until then.
+    #
+    for thread in threads:
+        thread.join()
+
+    return histogram, [threads[i % num_threads].paths[i] for i in range(len(header))]
+
+
+def _transpose_batches(reader, list_columns, list_separator, histogram):
+    """Read a CSV reader a batch at a time, and transpose each batch into columns.
+
+    Yields the header first, then the values of each column in the batch,
+    as an iterator with one item per column.  The values of list columns are
+    already split.  Malformed rows update the histogram, but are dropped
+    from the columns.
 
-    for q in queues:
-        q.join()
+    :arg csv.reader reader: An iterable that yields rows.
+    :arg list list_columns: A list of columns that should be split.
+    :arg str list_separator: The separator to use when splitting columns.
+    :arg collections.Counter histogram: The histogram of row lengths to update.
+    """
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise ValueError('Reader may not be empty')
+    yield header
 
-    return histogram, [thread._path for thread in threads]
+    #
+    # Work out which columns are lists once, up front.  Each batch is then
+    # transposed into columns by zip, in C, the same way _populate_queues
+    # does it, instead of handling one cell at a time.
+    #
+    list_columns = set(list_columns)
+    is_list = [name in list_columns for name in header]
+    expected_length = len(header)
+    for batch in make_batches(reader, batch_size=_batch_size(expected_length)):
+        batch_histogram = collections.Counter(map(len, batch))
+        histogram.update(batch_histogram)
+        if batch_histogram[expected_length] != len(batch):
+            batch = [row for row in batch if len(row) == expected_length]
+        #
+        # Transpose lazily, so that each column is consumed while it is
+        # still in the CPU caches.
+        #
+        yield (
+            list_separator.join(values).split(list_separator) if flag else values
+            for flag, values in zip(is_list, zip(*batch))
+        )
 
 
 def split_in_memory(reader, list_columns=[], list_separator=LIST_SEPARATOR):
@@ -168,19 +316,33 @@ def split_in_memory(reader, list_columns=[], list_separator=LIST_SEPARATOR):
     :arg str list_separator: The separator to use when splitting columns.
     :returns: header, histogram, values for each columns
     :rtype: tuple of (list, collections.Counter, list of lists)"""
-    try:
-        header = next(reader)
-    except StopIteration:
-        raise ValueError('Reader may not be empty')
     histogram = collections.Counter()
+    batches = _transpose_batches(reader, list_columns, list_separator, histogram)
+    header = next(batches)
     columns = [[] for _ in header]
-    for i, row in enumerate(reader, 1):
-        histogram[len(row)] += 1
-        if len(row) != len(header):
-            continue
-        for j, val in enumerate(row):
-            if header[j] in list_columns:
-                columns[j].extend(val.split(list_separator))
-            else:
-                columns[j].append(val)
+    for batch in batches:
+        for col, values in zip(columns, batch):
+            col.extend(values)
     return header, histogram, columns
+
+
+def count_in_memory(reader, list_columns=[], list_separator=LIST_SEPARATOR):
+    """Count the values in each column of the CSV reader, in-memory.
+
+    Like split_in_memory, but keeps the number of times each value occurs
+    instead of the values themselves, so it needs memory in proportion to
+    the number of unique values only.
+
+    :arg csv.reader reader: An iterable that yields rows.
+    :arg list list_columns: A list of columns that should be split.
+    :arg str list_separator: The separator to use when splitting columns.
+    :returns: header, histogram, value counts for each column
+    :rtype: tuple of (list, collections.Counter, list of collections.Counter)"""
+    histogram = collections.Counter()
+    batches = _transpose_batches(reader, list_columns, list_separator, histogram)
+    header = next(batches)
+    counts = [collections.Counter() for _ in header]
+    for batch in batches:
+        for counter, values in zip(counts, batch):
+            counter.update(values)
+    return header, histogram, counts
@@ -1,17 +1,36 @@
 """Summarize a single column of values."""
-import copy
+import codecs
+import collections
 import distutils.spawn
 import heapq
+import itertools
 import multiprocessing
-import pipes
+import operator
+import os
+import subprocess
 import sys
 import tempfile
+import threading
+
+from . import split
 
 NEWLINE = '\n'
+TEXT_ENCODING = 'utf-8'
+READ_SIZE = 1 << 20
+"""The number of bytes to read from sort at a time."""
 
 MOST_COMMON = 20
 """The default number of most common items to show in the summary."""
 
+MAX_ARGS = 100
+"""The max number of paths to pass to a single subprocess call."""
+
+MAX_UNIQUES = 1000000
+"""The max number of unique values to count in memory before falling back to sort."""
+
+MAX_BYTES = 256 << 20
+"""The max memory the unique values may take up before falling back to sort."""
+
 
 def run_length_encode(iterator):
     try:
@@ -22,18 +41,22 @@ def run_length_encode(iterator):
         #
         pass
     else:
+        #
+        # Test for equality first: it is the common case for sorted data with
+        # repeated values, and costs a single comparison.
+        #
         for value in iterator:
-            if value < run_value:
-                raise ValueError('unsorted iterator')
-            elif value != run_value:
+            if value == run_value:
+                run_length += 1
+            elif value > run_value:
                 yield run_value, run_length
                 run_value, run_length = value, 1
             else:
-                run_length += 1
+                raise ValueError('unsorted iterator')
         yield run_value, run_length
 
 
-class TopN(object):
+class TopN:
     def __init__(self, limit=MOST_COMMON):
         self._heap = []
         self._limit = limit
@@ -46,10 +69,17 @@ class TopN(object):
             if frequency > lowest_frequency:
                 heapq.heapreplace(self._heap, (frequency, value))
 
+    def min_frequency(self):
+        """Return the frequency that a value must exceed to make it into the top N."""
+        if len(self._heap) < self._limit:
+            return 0
+        return self._heap[0][0]
+
     def to_list(self):
-        heapsize = len(self._heap)
-        heapcopy = copy.deepcopy(self._heap)
-        return [heapq.heappop(heapcopy) for _ in range(heapsize)]
+        #
+        # Popping every item off a copy of the heap is the same as sorting it.
+        #
+        return sorted(self._heap)
 
 
 def summarize_sorted(iterator, most_common=MOST_COMMON):
@@ -60,21 +90,90 @@ def summarize_sorted(iterator, most_common=MOST_COMMON):
     min_len = sys.maxsize
     sum_len = 0
     topn = TopN(limit=most_common)
+    min_frequency = topn.min_frequency()
 
-    for run_value, run_length in run_length_encode(iterator):
-        if len(run_value) == 0:
+    #
+    # This is run_length_encode, inlined: a generator in between would cost
+    # an extra resume and tuple per run, which adds up for columns with many
+    # unique values.  A marker object at the end flushes the last run, and
+    # an empty iterator is a single run of markers, which never gets counted.
+    #
+    end = object()
+    iterator = iter(iterator)
+    run_value = next(iterator, end)
+    run_length = 1
+    for value in itertools.chain(iterator, (end,)):
+        if value == run_value:
+            run_length += 1
+            continue
+
+        val_len = len(run_value)
+        if val_len == 0:
             num_empty = run_length
+        if val_len > max_len:
+            max_len = val_len
+        if val_len < min_len:
+            min_len = val_len
         num_values += run_length
         num_uniques += 1
-        val_len = len(run_value)
-        max_len = max(max_len, val_len)
-        min_len = min(min_len, val_len)
         sum_len += val_len * run_length
-        topn.push(run_length, run_value)
+        #
+        # Most runs are too short to make it into the top N, so check that
+        # here instead of paying for a method call that does nothing.
+        #
+        if run_length > min_frequency:
+            topn.push(run_length, run_value)
+            min_frequency = topn.min_frequency()
+
+        if value is end:
+            break
+        if value < run_value:
+            raise ValueError('unsorted iterator')
+        run_value, run_length = value, 1
 
     if num_values == 0:
         raise ValueError('CSV file contains no data')
 
+    return _make_summary(num_values, num_empty, max_len, min_len, sum_len, num_uniques, topn)
+
+
+def summarize_counts(counts, most_common=MOST_COMMON):
+    """Summarize a column from the number of times each value occurs in it.
+
+    Gives the same result as summarize_sorted over the sorted column.
+
+    :arg dict counts: The number of occurrences, keyed by value.
+    :arg int most_common: The number of most common values to keep.
+    :returns: A summary of the column
+    :rtype: dict
+    """
+    if not counts:
+        raise ValueError('CSV file contains no data')
+
+    lengths = list(map(len, counts))
+    sum_len = sum(map(operator.mul, lengths, counts.values()))
+
+    #
+    # Only the values that occur at least as often as the Nth most common
+    # value can make it into the top N.  Push those in sorted order, so that
+    # ties get broken the same way as in summarize_sorted.
+    #
+    if len(counts) > most_common:
+        threshold = heapq.nlargest(most_common, counts.values())[-1]
+        candidates = [value for (value, count) in counts.items() if count >= threshold]
+    else:
+        candidates = counts
+    topn = TopN(limit=most_common)
+    for value in sorted(candidates):
+        topn.push(counts[value], value)
+
+    num_values = sum(counts.values())
+    num_empty = counts.get('', 0)
+    return _make_summary(num_values, num_empty, max(lengths), min(lengths), sum_len,
+                         len(counts), topn)
+
+
+def _make_summary(num_values, num_empty, max_len, min_len, sum_len, num_uniques, topn):
     return {
         'num_values': num_values,
         'num_fills': num_values - num_empty,
@@ -94,26 +193,168 @@ def _get_exe(*preference):
             return path
 
 
+def _feed(fout, paths, command, errors):
+    """Write the contents of the paths to fout.
+
+    Runs command on batches of paths, so that we never exceed the limit on
+    the length of a subprocess's argument list.  Closes fout when done.
+    Appends any exception raised to errors.
+    """
+    try:
+        for i in range(0, len(paths), MAX_ARGS):
+            subprocess.check_call(command + paths[i:i + MAX_ARGS], stdout=fout)
+    except Exception as err:
+        errors.append(err)
+    finally:
+        fout.close()
+
+
+def _read_lines(fin):
+    """Read lines from a binary file, a large chunk at a time.
+
+    Decoding and splitting a whole chunk at once is much faster than reading
+    one line at a time.
+
+    :arg fin: The file to read from.
+    :returns: A generator of lists of lines, without the newlines.
+    """
+    decoder = codecs.getincrementaldecoder(TEXT_ENCODING)()
+    tail = ''
+    while True:
+        chunk = fin.read(READ_SIZE)
+        text = tail + decoder.decode(chunk, final=not chunk)
+        lines = text.split(NEWLINE)
+        #
+        # The last item is whatever follows the last newline: the start of
+        # a line that the next chunk finishes, or an empty string.
+        #
+        tail = lines.pop()
+        yield lines
+        if not chunk:
+            break
+    if tail:
+        yield [tail]
+
+
 def sort_and_summarize(path, path_is_gzipped=True, compress_temporary=True, buffer_size='2G',
                        num_subprocesses=None, most_common=MOST_COMMON):
+    """Sort the values in a column and summarize them.
+
+    A column may be stored across multiple files, e.g. one per part of a
+    larger CSV file.  If so, pass a list of paths instead of a single path:
+    the files get read one after the other, without concatenating them first.
+
+    :arg path: The path, or a list of paths, to the files storing the column.
+    :arg bool path_is_gzipped: Whether the files are gzipped.
+    :arg bool compress_temporary: Whether sort should compress its temporary files.
+    :arg str buffer_size: The size of sort's main memory buffer.
+    :arg int num_subprocesses: The number of sorts to run concurrently.
+    :arg int most_common: The number of most common values to keep.
+    :returns: A summary of the column
+    :rtype: dict
+    """
     if num_subprocesses is None:
         num_subprocesses = multiprocessing.cpu_count()
+    paths = [path] if isinstance(path, str) else list(path)
+
     #
     # pigz is faster than gzip and therefore better.
     # gsort is always more complete than sort in some environments e.g. macOS
     #
     gzip_exe = _get_exe('pigz', 'gzip')
     sort_exe = _get_exe('gsort', 'sort')
-    template = pipes.Template()
-    if path_is_gzipped:
-        template.append('%s --decompress --stdout' % gzip_exe, '--')
-    sort_args = (sort_exe, tempfile.tempdir, num_subprocesses, buffer_size)
-    sort_cmd = ('LC_ALL=C %s --temporary-directory=%s '
-                '--parallel=%s --buffer-size=%s') % sort_args
+    sort_command = [
+        sort_exe,
+        '--temporary-directory=%s' % tempfile.gettempdir(),
+        '--parallel=%d' % num_subprocesses,
+        '--buffer-size=%s' % buffer_size,
+    ]
     if compress_temporary:
-        sort_cmd += ' --compress-program=%s' % gzip_exe
-    template.append(sort_cmd, '--')
-    with template.open(path, 'r') as fin:
-        lines = (line.rstrip(NEWLINE) for line in fin)
-        result = summarize_sorted(lines, most_common=most_common)
+        sort_command.append('--compress-program=%s' % gzip_exe)
+
+    if path_is_gzipped:
+        read_command = [gzip_exe, '--decompress', '--stdout']
+    else:
+        read_command = ['cat']
+
+    #
+    # Run sort directly instead of going through a shell, and read its output
+    # from this process.  A separate thread feeds it the input files.
+    #
+    env = dict(os.environ, LC_ALL='C')
+    sort = subprocess.Popen(sort_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    errors = []
+    feeder = threading.Thread(target=_feed, args=(sort.stdin, paths, read_command, errors))
+    feeder.start()
+
+    try:
+        with sort.stdout as fin:
+            lines = itertools.chain.from_iterable(_read_lines(fin))
+            result = summarize_sorted(lines, most_common=most_common)
+    finally:
+        feeder.join()
+        sort.wait()
+        #
+        # A failure to read the input is the root cause of anything that went
+        # wrong downstream, so it takes precedence.
+        #
+        if errors:
+            raise errors[0]
+
+    if sort.returncode:
+        raise subprocess.CalledProcessError(sort.returncode, sort.args)
     return result
+
+
+def count_and_summarize(path, path_is_gzipped=True, max_uniques=MAX_UNIQUES,
+                        max_bytes=MAX_BYTES, most_common=MOST_COMMON, **kwargs):
+    """Count the values in a column and summarize them.
+
+    Much faster than sorting the column, as long as the counts fit in memory.
+    If the column has more than max_uniques unique values, or they take up
+    more than max_bytes of memory, gives up and falls back to
+    sort_and_summarize.
+
+    :arg path: The path, or a list of paths, to the files storing the column.
+    :arg bool path_is_gzipped: Whether the files are gzipped.
+    :arg int max_uniques: The max number of unique values to count in memory.
+    :arg int max_bytes: The max memory the unique values may take up, in bytes.
+    :arg int most_common: The number of most common values to keep.
+    :arg kwargs: Passed on to sort_and_summarize when falling back to it.
+    :returns: A summary of the column
+    :rtype: dict
+    """
+    paths = [path] if isinstance(path, str) else list(path)
+    counts = _count_values(paths, path_is_gzipped, max_uniques, max_bytes)
+    if counts is None:
+        return sort_and_summarize(paths, path_is_gzipped=path_is_gzipped,
+                                  most_common=most_common, **kwargs)
+    return summarize_counts(counts, most_common=most_common)
+
+
+def _count_values(paths, path_is_gzipped, max_uniques, max_bytes):
+    """Count the values stored in the files, unless there are too many.
+
+    Reads the files a chunk at a time, and checks the limits after each
+    chunk, so that it gives up before using much more memory than allowed.
+
+    :returns: The number of occurrences keyed by value, or None if the
+        values exceed either of the limits.
+    :rtype: collections.Counter
+    """
+    opener = split.gzip.open if path_is_gzipped else open
+    counts = collections.Counter()
+    num_bytes = 0
+    for p in paths:
+        with opener(p, 'rb') as fin:
+            for values in _read_lines(fin):
+                #
+                # Long values (URLs, free text) use up memory long before
+                # there are too many of them, so keep track of the size of
+                # the new ones too.
+                #
+                num_bytes += sum(map(sys.getsizeof, set(values).difference(counts)))
+                counts.update(values)
+                if len(counts) > max_uniques or num_bytes > max_bytes:
+                    return None
+    return counts
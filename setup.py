@@ -40,6 +40,9 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'isal': ['isal'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='csvinsight',
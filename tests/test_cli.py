@@ -2,9 +2,12 @@
 import csv
 import io
 import os.path as P
+import tempfile
 
 from unittest import mock
 
+import pytest
+
 import csvinsight.cli
 
 CURR_DIR = P.dirname(P.abspath(__file__))
@@ -26,6 +29,32 @@ def test_run_in_memory():
     assert len(column_summaries) == 3
 
 
+@pytest.mark.parametrize('max_uniques', [1000, 1])
+@pytest.mark.parametrize('compress', [True, False])
+def test_process_multi(compress, max_uniques, tmpdir, monkeypatch):
+    #
+    # Splitting the file into several parts, and each part into columns,
+    # must give the same result as processing the file in memory.  With a
+    # single unique value allowed, every column gets sorted instead of counted.
+    #
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    monkeypatch.setattr(csvinsight.summarize, 'MAX_UNIQUES', max_uniques)
+    path = P.join(CURR_DIR, 'sampledata.csv')
+    dialect = csvinsight.cli._parse_dialect(())
+    args = mock.Mock(list_fields=['fave_color'], list_separator=';', most_common=20,
+                     subprocesses=2, no_compress=not compress)
+
+    with open(path) as fin:
+        header, expected_histogram, expected = csvinsight.cli._run_in_memory(
+            csvinsight.cli._make_reader(fin, dialect), args
+        )
+    part_paths = csvinsight.cli._split_large_file(path, lines_per_part=2, compress=compress)
+    assert len(part_paths) == 2
+    histogram, results = csvinsight.cli._process_multi(header, part_paths, dialect, args)
+    assert dict(histogram) == dict(expected_histogram)
+    assert results == expected
+
+
 def test_parse_dialect_delimiter():
     opts = ('delimiter=\t', 'quotechar=\'', 'escapechar=\\', 'doublequote=False',
             'skipinitialspace=False', 'lineterminator=\n', 'quoting=QUOTE_ALL')
@@ -92,3 +121,38 @@ def test_print_column_summary():
 
 """
     assert fout.getvalue() == expected
+
+
+def test_transpose_tables():
+    tables = [['a/0.gz', 'a/1.gz'], ['b/0.gz', 'b/1.gz'], ['c/0.gz', 'c/1.gz']]
+    expected = [['a/0.gz', 'b/0.gz', 'c/0.gz'], ['a/1.gz', 'b/1.gz', 'c/1.gz']]
+    assert csvinsight.cli._transpose_tables(tables) == expected
+
+    with pytest.raises(ValueError):
+        csvinsight.cli._transpose_tables([['a/0.gz', 'a/1.gz'], ['b/0.gz']])
+
+
+@pytest.mark.parametrize('opts', [(), ('escapechar=', 'skipinitialspace=False')])
+def test_make_reader_unquoted(opts, monkeypatch):
+    monkeypatch.setattr(csvinsight.cli, '_MIN_SPLIT_LINE_LENGTH', 0)
+    dialect = csvinsight.cli._parse_dialect(opts)
+    text = 'a|b\n\n|\n"q"|\'z\'\nc|d\r\n e| f\ng\\|h|i\\\nj\nk|l\nlast'
+    actual = list(csvinsight.cli._make_reader(io.StringIO(text, newline=''), dialect))
+    expected = list(csv.reader(io.StringIO(text, newline=''), dialect=dialect))
+    assert actual == expected
+
+
+def test_make_reader_unquoted_carriage_return(monkeypatch):
+    monkeypatch.setattr(csvinsight.cli, '_MIN_SPLIT_LINE_LENGTH', 0)
+    dialect = csvinsight.cli._parse_dialect(('escapechar=', 'skipinitialspace=False'))
+    reader = csvinsight.cli._make_reader(['a\rb|c\n'], dialect)
+    with pytest.raises(csv.Error):
+        list(reader)
+
+
+def test_make_reader_short_lines():
+    dialect = csvinsight.cli._parse_dialect(())
+    assert list(csvinsight.cli._make_reader(io.StringIO('a|b\nc\\|d\n'), dialect)) == [
+        ['a', 'b'], ['c|d'],
+    ]
+    assert list(csvinsight.cli._make_reader(io.StringIO(''), dialect)) == []
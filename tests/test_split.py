@@ -1,6 +1,8 @@
 import collections
+import gzip
 import io
 import queue
+import threading
 
 import pytest
 
@@ -8,30 +10,41 @@ import csvinsight.split
 
 
 def mock_batch():
-    yield ['foo', 'bar']
-    yield ['baz']
+    yield 0, 'foo\nbar'
+    yield 1, 'qux'
+    yield 0, 'baz'
     yield csvinsight.split.SENTINEL
 
 
 def test_writer_thread():
-    buf = io.BytesIO()
-    buf.close = lambda: None
+    bufs = [io.BytesIO(), io.BytesIO()]
+    for buf in bufs:
+        buf.close = lambda: None
 
     def open_temp_file(subdir, column_id):
-        return buf, '/%s/%04d.gz' % (subdir, column_id)
+        return bufs[column_id], '%s/%04d.gz' % (subdir, column_id)
 
-    q = queue.Queue()
+    q = queue.SimpleQueue()
     for batch in mock_batch():
         q.put(batch)
 
+    semaphore = threading.Semaphore(0)
     thread = csvinsight.split.WriterThread(
-        '/tmp/subdir', 0, q, open_temp=open_temp_file
+        '/tmp/subdir', [0, 1], q, open_temp=open_temp_file, semaphore=semaphore
     )
     thread.start()
     thread.join()
 
-    expected = b'foo\nbar\nbaz\n'
-    assert buf.getvalue() == expected
+    assert bufs[0].getvalue() == b'foo\nbar\nbaz\n'
+    assert bufs[1].getvalue() == b'qux\n'
+    assert thread.paths == {0: '/tmp/subdir/0000.gz', 1: '/tmp/subdir/0001.gz'}
+
+    #
+    # One release per batch written, none for the sentinel.
+    #
+    for _ in range(3):
+        assert semaphore.acquire(blocking=False)
+    assert not semaphore.acquire(blocking=False)
 
 
 def test_make_batches():
@@ -40,6 +53,12 @@ def test_make_batches():
     assert list(csvinsight.split.make_batches([1, 2, 3], 2)) == [[1, 2], [3]]
 
 
+def test_batch_size():
+    assert csvinsight.split._batch_size(1) == csvinsight.split.DEFAULT_BATCH_SIZE
+    assert csvinsight.split._batch_size(50) == csvinsight.split.BATCH_CELLS // 50
+    assert csvinsight.split._batch_size(10000) == csvinsight.split.MIN_BATCH_SIZE
+
+
 def test_run_in_memory():
     reader = [
         ('foo', 'bar', 'baz'),
@@ -55,6 +74,26 @@ def test_run_in_memory():
     assert columns == [['1', '0'], ['2', 'a', 'b'], ['3', '']]
 
 
+def test_count_in_memory():
+    reader = [
+        ('foo', 'bar', 'baz'),
+        ('1', '2', '3'),
+        ('0', 'a;b', ''),
+        ('', ''),
+        ('1', 'a', '3'),
+    ]
+    header, histogram, counts = csvinsight.split.count_in_memory(
+        iter(reader), list_columns=('bar',)
+    )
+    assert header == ('foo', 'bar', 'baz')
+    assert histogram == collections.Counter([3, 3, 2, 3])
+    assert counts == [
+        collections.Counter({'1': 2, '0': 1}),
+        collections.Counter({'a': 2, '2': 1, 'b': 1}),
+        collections.Counter({'3': 2, '': 1}),
+    ]
+
+
 def test_read_empty_file():
     with pytest.raises(ValueError):
         csvinsight.split.split_in_memory(iter([]))
@@ -68,18 +107,76 @@ def test_populate_queues():
                                       list_columns=['list'], batch_size=2)
 
     #
-    # Each list contains batches.
+    # Each batch is a single string, one value per line.
     #
     first = list(read_queue(queues[0]))
-    assert first == [['123', '456'], ['789']]
+    assert first == [(0, '123\n456'), (0, '789')]
 
     second = list(read_queue(queues[1]))
-    assert second == [['a', 'b', 'c', 'd', 'e', 'f'], ['g', 'h', 'i']]
+    assert second == [(1, 'a\nb\nc\nd\ne\nf'), (1, 'g\nh\ni')]
+
+
+def test_populate_queues_shared_queue():
+    header = ('value', 'list')
+    reader = [('123', 'a;b;c'), ('456', 'd')]
+    q = queue.Queue()
+    csvinsight.split._populate_queues(header, reader, [q, q], list_columns=['list'])
+
+    #
+    # Columns that share a queue get a single sentinel between them.
+    #
+    assert list(read_queue(q)) == [(0, '123\n456'), (1, 'a\nb\nc\nd')]
+    assert q.empty()
+
+
+def test_populate_queues_malformed():
+    header = ('value', 'list')
+    reader = [('123', 'a;b'), ('456',), ('789', 'c', 'oops'), ('1',), ('0', 'd')]
+    queues = (queue.Queue(), queue.Queue())
+    histogram = csvinsight.split._populate_queues(header, reader, queues,
+                                                  list_columns=['list'], batch_size=2)
+    assert histogram == collections.Counter([2, 1, 3, 1, 2])
+    #
+    # The second batch contains no well-formed rows, so it is skipped.
+    #
+    assert list(read_queue(queues[0])) == [(0, '123'), (0, '0')]
+    assert list(read_queue(queues[1])) == [(1, 'a\nb'), (1, 'd')]
 
 
 def read_queue(q):
     while True:
         item = q.get()
-        if item == csvinsight.split.SENTINEL:
+        if item is csvinsight.split.SENTINEL:
             break
         yield item
+
+
+def test_split_closes_files(tmpdir):
+    part = tmpdir.mkdir('parts').join('aa')
+    tmpdir.mkdir('columns')
+    header = ('value', 'list')
+    reader = [('123', 'a;b'), ('456', 'c'), ('',), ('', '')]
+    histogram, paths = csvinsight.split.split(header, iter(reader), list_columns=['list'],
+                                              path=str(part))
+    assert histogram == collections.Counter([2, 2, 1, 2])
+
+    #
+    # The files must be complete by the time split returns.
+    #
+    with gzip.open(paths[0], 'rt') as fin:
+        assert fin.read() == '123\n456\n\n'
+    with gzip.open(paths[1], 'rt') as fin:
+        assert fin.read() == 'a\nb\nc\n\n'
+
+
+def test_split_uncompressed(tmpdir):
+    part = tmpdir.mkdir('parts').join('aa')
+    tmpdir.mkdir('columns')
+    header = ('value', 'list')
+    reader = [('123', 'a;b'), ('456', 'c')]
+    _, paths = csvinsight.split.split(header, iter(reader), list_columns=['list'],
+                                      path=str(part), compress=False)
+    with open(paths[0]) as fin:
+        assert fin.read() == '123\n456\n'
+    with open(paths[1]) as fin:
+        assert fin.read() == 'a\nb\nc\n'
@@ -1,3 +1,8 @@
+import collections
+import gzip
+import io
+import itertools
+
 import pytest
 
 import csvinsight.summarize
@@ -18,6 +23,11 @@ def test_summarize_sorted():
     assert csvinsight.summarize.summarize_sorted(column) == expected
 
 
+def test_summarize_unsorted():
+    with pytest.raises(ValueError):
+        csvinsight.summarize.summarize_sorted(iter(('a', 'b', 'a')))
+
+
 def test_run_length_encode():
     expected = [(1, 1), (2, 2), (3, 3)]
     actual = list(csvinsight.summarize.run_length_encode(iter([1, 2, 2, 3, 3, 3])))
@@ -31,8 +41,10 @@ def test_top_n():
     topn = csvinsight.summarize.TopN(limit=3)
     topn.push(1, 'foo')
     topn.push(2, 'bar')
+    assert topn.min_frequency() == 0
     topn.push(3, 'baz')
     assert topn.to_list() == [(1, 'foo'), (2, 'bar'), (3, 'baz')]
+    assert topn.min_frequency() == 1
 
     topn.push(4, 'boz')
     assert topn.to_list() == [(2, 'bar'), (3, 'baz'), (4, 'boz')]
@@ -45,3 +57,132 @@ def test_no_data():
     empty = iter([])
     with pytest.raises(ValueError):
         list(csvinsight.summarize.summarize_sorted(empty))
+
+
+def test_sort_and_summarize(tmpdir):
+    path = str(tmpdir.join('column.gz'))
+    with gzip.open(path, 'wt') as fout:
+        fout.write('3\n2\n\n3\naa\n1\n3\n2\n')
+    actual = csvinsight.summarize.sort_and_summarize(path, num_subprocesses=1)
+    assert actual == csvinsight.summarize.summarize_sorted(
+        iter(('', '1', '2', '2', '3', '3', '3', 'aa'))
+    )
+
+
+def test_sort_and_summarize_uncompressed(tmpdir):
+    path = tmpdir.join('column')
+    path.write('b\na\nb\n')
+    actual = csvinsight.summarize.sort_and_summarize(
+        str(path), path_is_gzipped=False, compress_temporary=False, num_subprocesses=1
+    )
+    assert actual['num_uniques'] == 2
+    assert actual['most_common'] == [(2, 'b'), (1, 'a')]
+
+
+def write_parts(tmpdir):
+    """Write a column to several gzipped files, the same way split does."""
+    paths = []
+    for i, values in enumerate(('3\n2\n', '\n3\naa\n', '1\n3\n2\n')):
+        path = str(tmpdir.join('%d.gz' % i))
+        with gzip.open(path, 'wt') as fout:
+            fout.write(values)
+        paths.append(path)
+    return paths
+
+
+def summarize_parts():
+    """Summarize the column that write_parts writes."""
+    return csvinsight.summarize.summarize_sorted(iter(('', '1', '2', '2', '3', '3', '3', 'aa')))
+
+
+def test_sort_and_summarize_multiple_paths(tmpdir, monkeypatch):
+    #
+    # Make sure we exercise the batching of paths, too.
+    #
+    monkeypatch.setattr(csvinsight.summarize, 'MAX_ARGS', 2)
+    actual = csvinsight.summarize.sort_and_summarize(write_parts(tmpdir), num_subprocesses=1)
+    assert actual == summarize_parts()
+
+
+def test_summarize_counts():
+    #
+    # Several values tie for the last place in the top 3, and must be
+    # broken the same way in both cases.
+    #
+    column = ('', '', 'b', 'c', 'c', 'a', 'd', 'bb', 'a', 'ee', 'd')
+    actual = csvinsight.summarize.summarize_counts(collections.Counter(column), most_common=3)
+    assert actual == csvinsight.summarize.summarize_sorted(iter(sorted(column)), most_common=3)
+
+
+def test_summarize_counts_no_data():
+    with pytest.raises(ValueError):
+        csvinsight.summarize.summarize_counts({})
+
+
+@pytest.mark.parametrize('max_uniques', [100, 1])
+def test_count_and_summarize(tmpdir, max_uniques):
+    actual = csvinsight.summarize.count_and_summarize(
+        write_parts(tmpdir), max_uniques=max_uniques, num_subprocesses=1
+    )
+    assert actual == summarize_parts()
+
+
+def test_count_and_summarize_max_bytes(tmpdir, monkeypatch):
+    #
+    # The first part alone has two unique values, which take up more than
+    # a byte.
+    #
+    calls = []
+
+    def sort_and_summarize(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+
+    original = csvinsight.summarize.sort_and_summarize
+    monkeypatch.setattr(csvinsight.summarize, 'sort_and_summarize', sort_and_summarize)
+    actual = csvinsight.summarize.count_and_summarize(
+        write_parts(tmpdir), max_bytes=1, num_subprocesses=1
+    )
+    assert actual == summarize_parts()
+    assert len(calls) == 1
+
+
+def test_count_and_summarize_gives_up_early(tmpdir, monkeypatch):
+    #
+    # Read one value at a time.  The first value alone takes up more than
+    # a byte, so counting must give up before reading the rest of the first
+    # part, which holds two.
+    #
+    monkeypatch.setattr(csvinsight.summarize, 'READ_SIZE', 2)
+    chunks_read = []
+    calls = []
+
+    def read_lines(fin):
+        for lines in original_read_lines(fin):
+            chunks_read.append(lines)
+            yield lines
+
+    def sort_and_summarize(*args, **kwargs):
+        calls.append(len(chunks_read))
+        return original_sort_and_summarize(*args, **kwargs)
+
+    original_read_lines = csvinsight.summarize._read_lines
+    original_sort_and_summarize = csvinsight.summarize.sort_and_summarize
+    monkeypatch.setattr(csvinsight.summarize, '_read_lines', read_lines)
+    monkeypatch.setattr(csvinsight.summarize, 'sort_and_summarize', sort_and_summarize)
+    actual = csvinsight.summarize.count_and_summarize(
+        write_parts(tmpdir), max_bytes=1, num_subprocesses=1
+    )
+    assert actual == summarize_parts()
+    assert calls == [1]
+
+
+def test_read_lines(monkeypatch):
+    #
+    # Make the chunks small enough to split lines, and characters, between
+    # them.
+    #
+    monkeypatch.setattr(csvinsight.summarize, 'READ_SIZE', 3)
+    fin = io.BytesIO('é\naé\n\nbb\nc'.encode('utf-8'))
+    lines = itertools.chain.from_iterable(csvinsight.summarize._read_lines(fin))
+    assert list(lines) == ['é', 'aé', '', 'bb', 'c']